@@ -1,7 +1,14 @@
 import os
+from contextlib import contextmanager
 from datetime import date
 from pathlib import Path
 
+import matplotlib
+
+# 默认使用非交互式 Agg 后端，避免加载 GUI；可通过 MPLBACKEND 环境变量指定其他后端
+if 'MPLBACKEND' not in os.environ:
+    matplotlib.use('Agg')
+
 import clickhouse_driver
 import matplotlib.pyplot as plt
 import numpy as np
@@ -11,11 +18,97 @@ from sqlalchemy.orm import sessionmaker
 
 from config import settings
 
+try:
+    from clickhouse_pool import ChPool
+except ImportError:  # 未安装 clickhouse-pool 时退回单个 clickhouse_driver.Client
+    ChPool = None
+
+try:
+    # clickhouse_driver 的 LZ4 压缩需要 lz4 与 clickhouse-cityhash
+    import clickhouse_cityhash
+    import lz4
+except ImportError:  # 未安装时不压缩传输
+    _COMPRESSION = False
+else:
+    _COMPRESSION = 'lz4'
+
+try:
+    import numba
+except ImportError:  # 未安装 numba 时退回 Cython / NumPy 实现
+    numba = None
+
+if numba is not None:
+    _daily_cpi_cython = None
+else:
+    # 仅在没有 numba 时才编译 Cython 内核，避免导入时不必要地编译 C 代码
+    try:
+        import pyximport
+    except ImportError:  # 未安装 Cython 时退回 NumPy 实现
+        _daily_cpi_cython = None
+    else:
+        # 仅在导入 cpi_kernel 期间启用 .pyx 导入钩子
+        _pyx_importers = pyximport.install(language_level=3)
+        try:
+            from cpi_kernel import daily_cpi as _daily_cpi_cython
+        except Exception:  # 编译失败（如缺少编译器）时退回 NumPy 实现
+            _daily_cpi_cython = None
+        finally:
+            pyximport.uninstall(*_pyx_importers)
+
+# 进程内共享的 ClickHouse 连接池，按连接配置区分
+_POOLS = {}
+
+# 类别、产品维度表的本地缓存目录
+CACHE_PATH = Path(__file__).resolve().parent.parent.parent / 'data' / '_cache'
+
+
+# 连续日期区间内逐产品、逐日的价格（CTE 定义，以 WITH 引入）：
+# 补齐区间内的每一天，缺失价格沿用此前最近一次报价，首次报价前为 NaN。
+# 参数为 start_date、end_date 和区间天数 n_days
+_FILLED_PRICES_CTE = """
+    dates AS (
+        SELECT arrayJoin(arrayMap(i -> toDate(%(start_date)s) + i, range(%(n_days)s))) AS d
+    ),
+    daily_prices AS (
+        SELECT product_id, toDate(date) AS d, toNullable(any(price)) AS price
+        FROM prices
+        WHERE toDate(date) BETWEEN toDate(%(start_date)s) AND toDate(%(end_date)s)
+        GROUP BY product_id, d
+    ),
+    spine AS (
+        SELECT product_id, dates.d AS d
+        FROM (SELECT DISTINCT product_id FROM daily_prices) AS ps
+        CROSS JOIN dates
+    ),
+    filled_prices AS (
+        SELECT
+            s.product_id AS product_id,
+            s.d AS d,
+            CAST(ifNull(last_value(dp.price) OVER (
+                PARTITION BY s.product_id ORDER BY s.d
+                ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+            ), nan) AS Float32) AS price
+        FROM spine s
+        LEFT JOIN daily_prices dp ON s.product_id = dp.product_id AND s.d = dp.d
+    )
+"""
+
+
+class _SingleClientPool:
+    """未安装 clickhouse-pool 时的替代，与 ChPool 接口一致，所有查询共用同一个 Client"""
+
+    def __init__(self, **client_kwargs):
+        self._client = clickhouse_driver.Client(**client_kwargs)
+
+    @contextmanager
+    def get_client(self):
+        yield self._client
+
 
 class CPICalculator:
     def __init__(self, db_config):
         self.db_config = db_config
-        self.clickhouse_client = self._connect_clickhouse()
+        self.clickhouse_pool = self._connect_clickhouse()
         self.sqlalchemy_engine = self._connect_sqlalchemy()
         self.Session = sessionmaker(bind=self.sqlalchemy_engine)
 
@@ -23,62 +116,171 @@ class CPICalculator:
         self.categories = self._load_categories()
         self.products = self._load_products()
 
+        # 预先计算叶子类别及其权重，供每日 CPI 计算直接按下标使用
+        parents = self.categories.loc[self.categories['parent'] != -1, 'parent'].unique()
+        is_leaf = ~np.isin(self.categories['category_id'].to_numpy(), parents)
+        self._leaf_cat_ids = self.categories['category_id'].to_numpy()[is_leaf]
+        self._leaf_weights = self.categories['weight'].to_numpy(np.float64)[is_leaf]
+
+        # 产品按 product_id 建索引；类别转为以叶子类别为取值的分类类型，
+        # 其编码即 _leaf_weights 中的下标，非叶子类别的编码为 -1
+        self.products = self.products.set_index('product_id')
+        self.products['category_id'] = pd.Categorical(
+            self.products['category_id'], categories=self._leaf_cat_ids
+        )
+
     def _connect_clickhouse(self):
-        """连接到 ClickHouse 数据库"""
-        return clickhouse_driver.Client(
+        """
+        获取 ClickHouse 连接池，连接配置相同的实例复用已建立的连接。
+
+        安装了 lz4 与 clickhouse-cityhash 时传输启用 LZ4 压缩；连接池依赖可选的 clickhouse-pool。
+        """
+        client_kwargs = dict(
             host=self.db_config['HOST'],
             port=self.db_config['PORT'],
             user=self.db_config['USER'],
-            password=self.db_config['PASSWORD']
+            password=self.db_config['PASSWORD'],
+            database=self.db_config.get('DATABASE', 'default'),
         )
+        key = tuple(client_kwargs.values())
+        if key not in _POOLS:
+            client_kwargs.update(
+                compression=_COMPRESSION,
+                send_receive_timeout=600,
+                settings={'max_block_size': 131072, 'max_execution_time': 600}
+            )
+            if ChPool is not None:
+                _POOLS[key] = ChPool(connections_min=2, connections_max=8, **client_kwargs)
+            else:
+                _POOLS[key] = _SingleClientPool(**client_kwargs)
+        return _POOLS[key]
 
     def _connect_sqlalchemy(self):
         """连接 SQLAlchemy 引擎"""
         return create_engine(self.db_config['SQLALCHEMY_DATABASE_URI'])
 
-    def _execute_clickhouse_query(self, query):
-        """执行 ClickHouse 查询"""
-        return self.clickhouse_client.execute(query)
+    def _execute_clickhouse_query(self, query, params=None, columnar=False, external_tables=None):
+        """
+        执行 ClickHouse 查询，params 为查询参数。
+
+        columnar=True 时按列返回结果及列类型，并启用 use_numpy 使各列直接解码为 np.ndarray
+        （需要 clickhouse-driver[numpy]）。
+        """
+        with self.clickhouse_pool.get_client() as client:
+            if columnar:
+                return client.execute(
+                    query, params, with_column_types=True, columnar=True,
+                    external_tables=external_tables, settings={'use_numpy': True}
+                )
+            return client.execute(query, params, external_tables=external_tables)
+
+    def _execute_columnar(self, query, params=None):
+        """执行 ClickHouse 查询，并以 {列名: np.ndarray} 的形式返回结果，数值列保持 ClickHouse 中的类型"""
+        columns, column_types = self._execute_clickhouse_query(query, params, columnar=True)
+        if not columns:
+            return {name: np.empty(0) for name, _ in column_types}
+        return dict(zip((name for name, _ in column_types), columns))
+
+    def _leaf_cats_table(self):
+        """将缓存的叶子类别及权重作为外部表 leaf_cats 随查询发送，避免在 SQL 中重复扫描 categories"""
+        return {
+            'name': 'leaf_cats',
+            'structure': [('category_id', 'Int64'), ('weight', 'Float64')],
+            'data': [
+                {'category_id': int(cid), 'weight': float(w)}
+                for cid, w in zip(self._leaf_cat_ids, self._leaf_weights)
+            ],
+        }
+
+    def _table_version(self, table):
+        """
+        返回 ClickHouse 表数据最近一次变更的时间戳（活跃数据分片的最大修改时间）。
+
+        只有在本地存储数据分片的 MergeTree 系列表才能据此判断变更；
+        没有活跃分片的表（Memory、Log、View、Distributed、S3、URL 等）返回 None。
+        """
+        query = """
+            SELECT count(), toUnixTimestamp(max(modification_time))
+            FROM system.parts
+            WHERE database = currentDatabase() AND table = %(table)s AND active
+        """
+        n_parts, version = self._execute_clickhouse_query(query, {'table': table})[0]
+        return version if n_parts else None
+
+    def _load_cached(self, table, query, columns):
+        """
+        加载维度表，按连接配置和表的最近修改时间缓存为本地 parquet 文件。
+
+        表在 ClickHouse 中没有变更时直接读取缓存；缓存读写失败（如未安装 pyarrow、目录只读）时直接使用查询结果。
+        只缓存本地有数据分片的 MergeTree 系列表，其他引擎的表无法判断是否变更，每次都直接查询。
+        """
+        version = self._table_version(table)
+        if version is None:
+            return pd.DataFrame(self._execute_clickhouse_query(query), columns=columns)
+
+        prefix = '-'.join(str(v) for v in (
+            table, self.db_config['HOST'], self.db_config['PORT'],
+            self.db_config['USER'], self.db_config.get('DATABASE', 'default')
+        ))
+        cache = CACHE_PATH / f'{prefix}-{version}.parquet'
+        if cache.exists():
+            try:
+                return pd.read_parquet(cache)
+            except Exception as e:
+                print(f"读取本地缓存 {cache} 失败: {e}")
+
+        result = self._execute_clickhouse_query(query)
+        df = pd.DataFrame(result, columns=columns)
+        try:
+            CACHE_PATH.mkdir(parents=True, exist_ok=True)
+            for stale in CACHE_PATH.glob(f'{prefix}-*.parquet'):
+                stale.unlink()
+            df.to_parquet(cache, compression='zstd')
+        except Exception as e:
+            print(f"写入本地缓存 {cache} 失败: {e}")
+        return df
 
     def _load_categories(self):
         """从 ClickHouse 加载所有类别信息"""
         query = "SELECT category_id, parent, weight FROM categories"
-        result = self._execute_clickhouse_query(query)
-        return pd.DataFrame(result, columns=["category_id", "parent", "weight"])
+        return self._load_cached('categories', query, ["category_id", "parent", "weight"])
 
     def _load_products(self):
         """从 ClickHouse 加载产品信息"""
         query = "SELECT product_id, category_id FROM products"
-        result = self._execute_clickhouse_query(query)
-        return pd.DataFrame(result, columns=["product_id", "category_id"])
+        return self._load_cached('products', query, ["product_id", "category_id"])
 
     def _load_prices_for_dates(self, date_tuple):
-        """加载指定日期范围的产品价格"""
-        date_list = "', '".join(str(d) for d in date_tuple)
+        """
+        加载连续日期区间内的产品价格，在 ClickHouse 中补齐日期并前向填充缺失价格。
+
+        :param date_tuple: 连续的日期序列，第一个日期为基期
+        :return: (product_ids, prices)，prices 为 [产品数, 日期数] 的 float32 价格矩阵，首次报价前的价格为 NaN
+        """
         query = f"""
-            SELECT product_id, price, toDate(date) AS date
-            FROM prices
-            WHERE date IN ('{date_list}')
+            WITH {_FILLED_PRICES_CTE}
+            SELECT product_id, price
+            FROM filled_prices
+            ORDER BY product_id, d
         """
-        result = self._execute_clickhouse_query(query)
-        return pd.DataFrame(result, columns=["product_id", "price", "date"])
+        n_days = len(date_tuple)
+        params = {'start_date': date_tuple[0], 'end_date': date_tuple[-1], 'n_days': n_days}
+        result = self._execute_columnar(query, params)
+        # 每个产品恰好 n_days 行且按日期排序，可直接重排为 [产品数, 日期数] 的矩阵
+        prices = result['price'].astype(np.float32, copy=False).reshape(-1, n_days)
+        return result['product_id'][::n_days], prices
 
     def compute_cpi(self, start_date, end_date):
         """使用 ClickHouse SQL 计算指定时间区间 CPI"""
-        sql_query = f"""
+        sql_query = """
         WITH
-        leaf_categories AS (
-            SELECT category_id, weight
-            FROM categories
-            WHERE category_id NOT IN (SELECT parent FROM categories WHERE parent != -1)
-        ),
         price_data AS (
             SELECT
                 product_id,
-                MAXIf(price, toDate(date) = toDate('{start_date}')) AS base_price,
-                MAXIf(price, toDate(date) = toDate('{end_date}')) AS report_price
+                MAXIf(price, toDate(date) = toDate(%(start_date)s)) AS base_price,
+                MAXIf(price, toDate(date) = toDate(%(end_date)s)) AS report_price
             FROM prices
-            WHERE date IN ('{start_date}', '{end_date}')
+            WHERE date IN %(dates)s
             GROUP BY product_id
         ),
         category_cpi AS (
@@ -87,86 +289,179 @@ class CPICalculator:
                 EXP(avg(log(pd.report_price / pd.base_price))) AS price_index
             FROM products p
             JOIN price_data pd ON p.product_id = pd.product_id
-            JOIN leaf_categories lc ON p.category_id = lc.category_id
+            JOIN leaf_cats lc ON p.category_id = lc.category_id
             WHERE pd.base_price > 0 AND pd.report_price IS NOT NULL
             GROUP BY p.category_id
         )
         SELECT
             SUM(cc.price_index * lc.weight) AS CPI
         FROM category_cpi cc
-        JOIN leaf_categories lc ON cc.category_id = lc.category_id;
+        JOIN leaf_cats lc ON cc.category_id = lc.category_id;
         """
+        params = {'start_date': start_date, 'end_date': end_date, 'dates': (start_date, end_date)}
         try:
-            result = self._execute_clickhouse_query(sql_query)
+            result = self._execute_clickhouse_query(
+                sql_query, params, external_tables=[self._leaf_cats_table()]
+            )
             return result[0][0] if result else None
         except Exception as e:
             print(f"ClickHouse CPI SQL 执行失败: {e}")
             return None
 
+    def compute_daily_cpi_sql(self, start_date: date, end_date: date) -> pd.Series:
+        """
+        使用单条 ClickHouse SQL 按日期分组计算每日 CPI，结果以流式方式读取。
+
+        与 compute_daily_cpi 共用前向填充后的价格，两者结果一致。
+        """
+        sql_query = f"""
+        WITH {_FILLED_PRICES_CTE},
+        base AS (
+            SELECT product_id, toFloat64(price) AS base_price
+            FROM filled_prices
+            WHERE d = toDate(%(start_date)s) AND price > 0
+        ),
+        category_cpi AS (
+            SELECT
+                fp.d AS d,
+                p.category_id AS category_id,
+                EXP(avg(log(toFloat64(fp.price) / b.base_price))) AS price_index
+            FROM filled_prices fp
+            JOIN base b ON fp.product_id = b.product_id
+            JOIN products p ON fp.product_id = p.product_id
+            JOIN leaf_cats lc ON p.category_id = lc.category_id
+            WHERE NOT isNaN(fp.price)
+            GROUP BY d, category_id
+        )
+        SELECT
+            cc.d,
+            SUM(cc.price_index * lc.weight) AS CPI
+        FROM category_cpi cc
+        JOIN leaf_cats lc ON cc.category_id = lc.category_id
+        GROUP BY cc.d
+        ORDER BY cc.d;
+        """
+        n_days = (end_date - start_date).days + 1
+        params = {'start_date': start_date, 'end_date': end_date, 'n_days': n_days}
+        days, values = [], []
+        try:
+            with self.clickhouse_pool.get_client() as client:
+                for d, cpi in client.execute_iter(
+                        sql_query, params, external_tables=[self._leaf_cats_table()]
+                ):
+                    days.append(d)
+                    values.append(cpi)
+        except Exception as e:
+            print(f"ClickHouse 每日 CPI SQL 执行失败: {e}")
+            return None
+        return pd.Series(values, index=days, dtype='float64').round(4)
+
     def compute_daily_cpi(self, start_date: date, end_date: date) -> pd.Series:
         """计算每日 CPI 指数"""
-        leaf_categories = self.categories[
-            ~self.categories['category_id'].isin(self.categories['parent'].dropna())
-        ][['category_id', 'weight']]
-
         all_dates = pd.date_range(start_date, end_date, freq='D').date
-        price_data = self._load_prices_for_dates(all_dates)
-
-        price_pivot = price_data.pivot_table(
-            index='product_id',
-            columns='date',
-            values='price',
-            aggfunc='first'
-        ).ffill(axis=1)
-
-        base_prices = price_pivot[start_date].rename('base_price')
-
-        merged_data = self.products.merge(
-            base_prices,
-            left_on='product_id',
-            right_index=True
-        ).merge(
-            leaf_categories,
-            on='category_id'
+        product_ids, prices = self._load_prices_for_dates(all_dates)
+        # 末尾追加一行 NaN，使没有价格记录的产品（下标 -1）落到该行
+        prices = np.vstack([prices, np.full((1, len(all_dates)), np.nan, dtype=prices.dtype)])
+
+        # 只保留叶子类别下的产品，并按类别排序使同一类别的行在矩阵中连续
+        codes = self.products['category_id'].cat.codes.to_numpy()
+        order = np.argsort(codes, kind='stable')
+        order = order[codes[order] >= 0]
+        cat_codes, offsets, cat_of_product = np.unique(
+            codes[order], return_index=True, return_inverse=True
         )
+        weights = self._leaf_weights[cat_codes]
 
-        cpi_series = pd.Series(index=all_dates, dtype='float64')
-
-        for current_date in all_dates:
-            current_prices = price_pivot[current_date].rename('current_price')
-            daily_data = merged_data.merge(
-                current_prices,
-                left_on='product_id',
-                right_index=True
-            )
+        prices = prices[pd.Index(product_ids).get_indexer(self.products.index[order])]
+        cpi_values = _daily_cpi_kernel(prices, cat_of_product, offsets, weights)
 
-            valid_data = daily_data[
-                (daily_data['base_price'] > 0) & (daily_data['current_price'].notnull())
-                ].copy()
+        return pd.Series(cpi_values, index=all_dates, dtype='float64').round(4)
 
-            valid_data['price_ratio'] = valid_data['current_price'] / valid_data['base_price']
-            valid_data['log_ratio'] = np.log(valid_data['price_ratio'])
 
-            category_index = valid_data.groupby('category_id')['log_ratio'].mean().apply(np.exp)
-
-            final_data = category_index.reset_index(name='price_index').merge(
-                leaf_categories,
-                on='category_id'
-            )
+def _daily_cpi_kernel(prices: np.ndarray, cat_of_product: np.ndarray,
+                      offsets: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """
+    由价格矩阵计算每日 CPI，优先使用 numba JIT 内核，未安装 numba 时使用 Cython 内核，最后退回 NumPy 实现。
 
-            cpi_series[current_date] = (final_data['price_index'] * final_data['weight']).sum()
+    :param prices: 形状为 [产品数, 天数] 的价格矩阵，第 0 列为基期价格，行按类别排序
+    :param cat_of_product: 每个产品所属类别的下标
+    :param offsets: 每个类别在行方向上的起始下标
+    :param weights: 每个类别的权重
+    :return: 每日 CPI 数组
+    """
+    if numba is not None:
+        # 按列存储，使内核逐日遍历产品时访问连续内存
+        return _daily_cpi_numba(
+            np.asfortranarray(prices), cat_of_product.astype(np.int64), weights, len(weights)
+        )
+    if _daily_cpi_cython is not None:
+        # 按列存储，使内核逐日遍历产品时访问连续内存
+        return _daily_cpi_cython(
+            np.asfortranarray(prices, dtype=np.float32), cat_of_product.astype(np.int64),
+            np.ascontiguousarray(weights, dtype=np.float64), len(weights)
+        )
+    return _daily_cpi_numpy(prices, offsets, weights)
 
-        return cpi_series.astype('float64').round(4)
 
+def _daily_cpi_numpy(prices: np.ndarray, offsets: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """
+    由价格矩阵计算每日 CPI（NumPy 实现）。
 
-def plot_cpi_trend(cpi_series: pd.Series, output_path: str = None):
+    :param prices: 形状为 [产品数, 天数] 的价格矩阵，第 0 列为基期价格，行按类别排序
+    :param offsets: 每个类别在行方向上的起始下标
+    :param weights: 每个类别的权重
+    :return: 每日 CPI 数组
+    """
+    base = prices[:, 0:1]
+    valid = (base > 0) & ~np.isnan(prices)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_ratio = np.where(valid, np.log(prices) - np.log(base), 0.0)
+
+    # 价格矩阵为 float32，类别内求和在 float64 中累加以避免精度漂移
+    sum_by_cat = np.add.reduceat(log_ratio, offsets, axis=0, dtype=np.float64)
+    cnt_by_cat = np.add.reduceat(valid.astype(np.float64), offsets, axis=0)
+    # 当日没有有效价格的类别不计入 CPI
+    mean_log = np.divide(sum_by_cat, cnt_by_cat, out=np.zeros_like(sum_by_cat), where=cnt_by_cat > 0)
+    price_index = np.where(cnt_by_cat > 0, np.exp(mean_log), 0.0)
+
+    return weights @ price_index
+
+
+if numba is not None:
+    # fastmath 不开启 nnan/ninf，否则 NaN 判断会被编译器优化掉
+    @numba.njit(parallel=True, cache=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'})
+    def _daily_cpi_numba(prices, cat_of_product, weights, n_cats):
+        """由价格矩阵计算每日 CPI（numba 实现），按天并行"""
+        n_products, n_days = prices.shape
+        cpi = np.zeros(n_days)
+        for day in numba.prange(n_days):
+            sum_log = np.zeros(n_cats)
+            cnt = np.zeros(n_cats, dtype=np.int64)
+            for p in range(n_products):
+                # 与 Cython 内核一致，价格比及其对数在 float64 中计算
+                base = np.float64(prices[p, 0])
+                price = np.float64(prices[p, day])
+                if base > 0 and not np.isnan(price):
+                    sum_log[cat_of_product[p]] += np.log(price / base)
+                    cnt[cat_of_product[p]] += 1
+
+            total = 0.0
+            for c in range(n_cats):
+                if cnt[c] > 0:
+                    total += weights[c] * np.exp(sum_log[c] / cnt[c])
+            cpi[day] = total
+        return cpi
+
+
+def plot_cpi_trend(cpi_series: pd.Series, output_path: str = None, dpi: int = 300):
     """
     绘制 CPI 趋势图，并可选地导出为图片报告。
 
     :param cpi_series: 时间序列形式的 CPI 指数（pd.Series, index 为日期）
     :param output_path: 可选，保存路径，支持 .png 格式（例如 'output/cpi_trend.png'）
+    :param dpi: 导出图片的分辨率
     """
-    plt.figure(figsize=(15, 6))
+    fig = plt.figure(figsize=(15, 6))
     cpi_series.plot(
         kind='line',
         title='Daily Consumer Price Index Trend',
@@ -177,16 +472,16 @@ def plot_cpi_trend(cpi_series: pd.Series, output_path: str = None):
         marker='o',
         markersize=4
     )
-    plt.gcf().autofmt_xdate()
-    plt.tight_layout()
-    plt.gcf().autofmt_xdate()
-    plt.tight_layout()
+    fig.autofmt_xdate()
+    fig.tight_layout()
 
     if output_path:
-        plt.savefig(output_path, dpi=300)
+        fig.savefig(output_path, dpi=dpi)
         print(f"图表已保存至: {output_path}")
+    else:
+        plt.show()
 
-    plt.show()
+    plt.close(fig)
 
 
 def run(start_date: date, end_date: date):
@@ -205,7 +500,7 @@ def run(start_date: date, end_date: date):
         # 4. 结果输出
         print("生成可视化报告...",flush=True)
         print(daily_cpi,flush=True)
-        plot_cpi_trend(daily_cpi, os.path.join(data_path, 'cpi_trend.png'))
+        plot_cpi_trend(daily_cpi, os.path.join(data_path, 'cpi_trend.png'), dpi=150)
         print("处理成功 | 可视化引擎: matplotlib",flush=True)
     except Exception as e:
         print("流程异常终止",flush=True)
@@ -0,0 +1,43 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True, language_level=3
+"""每日 CPI 计算内核（Cython + OpenMP 实现）"""
+import numpy as np
+
+from cython.parallel import prange
+from libc.math cimport exp, isnan, log
+
+
+def daily_cpi(const float[::1, :] prices, const long long[::1] cat_of_product,
+              const double[::1] weights, Py_ssize_t n_cats):
+    """
+    由价格矩阵计算每日 CPI，按天并行。
+
+    :param prices: 按列存储的 [产品数, 天数] float32 价格矩阵，第 0 列为基期价格
+    :param cat_of_product: 每个产品所属类别的下标
+    :param weights: 每个类别的权重
+    :param n_cats: 类别数
+    :return: 每日 CPI 数组
+    """
+    cdef Py_ssize_t n_products = prices.shape[0]
+    cdef Py_ssize_t n_days = prices.shape[1]
+    cdef Py_ssize_t day, p, c
+    cdef double base, price, total
+    # 每天独占一行累加缓冲，线程之间无需同步
+    cdef double[:, ::1] sum_log = np.zeros((n_days, n_cats))
+    cdef long long[:, ::1] cnt = np.zeros((n_days, n_cats), dtype=np.int64)
+    cdef double[::1] cpi = np.zeros(n_days)
+
+    for day in prange(n_days, nogil=True, schedule='static'):
+        for p in range(n_products):
+            base = prices[p, 0]
+            price = prices[p, day]
+            if base > 0 and not isnan(price):
+                sum_log[day, cat_of_product[p]] += log(price / base)
+                cnt[day, cat_of_product[p]] += 1
+
+        total = 0
+        for c in range(n_cats):
+            if cnt[day, c] > 0:
+                total = total + weights[c] * exp(sum_log[day, c] / cnt[day, c])
+        cpi[day] = total
+
+    return np.asarray(cpi)